@@ -5,7 +5,7 @@ _obi()
     cur="${COMP_WORDS[COMP_CWORD]}"
 
     if [ $COMP_CWORD -eq 1 ]; then
-        COMPREPLY=( $( compgen -W '-h --help --version rsync template stop build clean go new fetch' -- $cur) )
+        COMPREPLY=( $( compgen -W '-h --help --version rsync template stop build clean go new fetch profile' -- $cur) )
     else
         case ${COMP_WORDS[1]} in
             rsync)
@@ -31,6 +31,9 @@ _obi()
         ;;
             fetch)
             _obi_fetch
+        ;;
+            profile)
+            _obi_profile
         ;;
         esac
 
@@ -194,6 +197,19 @@ _obi_fetch()
     fi
 }
 
+_obi_profile()
+{
+    local cur
+    cur="${COMP_WORDS[COMP_CWORD]}"
+
+    if [ $COMP_CWORD -eq 2 ]; then
+        COMPREPLY=( $( compgen -W "$(_obi_roomnames) --dry-run " -- $cur) )
+    fi
+    if [ $COMP_CWORD -gt 2 ]; then
+      COMPREPLY=( $( compgen -W '--duration= --dry-run --' -- $cur) )
+    fi
+}
+
 _obi_installed_templates ()
 {
   echo $(obi template list | tail -n +2)
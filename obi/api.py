@@ -0,0 +1,294 @@
+'''
+Embeddable Python API for obi
+
+The obi command line re-reads project.yaml and reconnects to every host each
+time it is invoked. A Session loads the configuration for one room once and
+keeps it around for as many operations as a script cares to run. Sessions
+created with parallel=False also keep fabric's ssh connections open between
+calls (see Session):
+
+    from obi.api import Session
+
+    with Session("/path/to/project", "room") as session:
+        session.rsync()
+        results = session.build()
+        if not results.ok:
+            for host, result in results.items():
+                print(host, result.exit_code, "\\n".join(result.output))
+        session.stop()
+        session.launch(extras=["--feld=left"])
+
+Every operation returns a TaskResults, a Dict mapping each host to a
+HostResult. Failures are reported per host instead of aborting the process.
+'''
+from __future__ import print_function
+import collections
+import os
+import time
+
+import fabric
+import fabric.network
+from fabric.api import env
+
+from . import task
+from .task import flamegraph
+
+class ObiError(Exception):
+    """
+    Raised in place of fabric's abort (which exits the process) while a
+    Session is active
+    """
+    pass
+
+class HostResult(object):
+    """
+    Outcome of running one operation on one host
+    - ok: True if every command succeeded
+    - exit_code: exit code of the failing command, else of the last command
+    - elapsed: wall-clock seconds spent on the host
+    - output: the last few lines of output of the commands run on the host
+    - error: the error message, if the operation failed
+    - value: whatever the underlying task returned
+    """
+    def __init__(self, host, ok, exit_code, elapsed, output, error=None, value=None):
+        self.host = host
+        self.ok = ok
+        self.exit_code = exit_code
+        self.elapsed = elapsed
+        self.output = output
+        self.error = error
+        self.value = value
+
+    def __repr__(self):
+        return "<HostResult {0} ok={1} exit_code={2} elapsed={3:.2f}s>".format(
+            self.host, self.ok, self.exit_code, self.elapsed)
+
+class TaskResults(dict):
+    """
+    Dict of host string -> HostResult for one operation
+    """
+    @property
+    def ok(self):
+        return all(result.ok for result in self.values())
+
+    @property
+    def failed(self):
+        return sorted(host for host, result in self.items() if not result.ok)
+
+def _tail(text, lines):
+    """
+    Returns the last `lines` lines of text as a list
+    """
+    if lines <= 0:
+        return []
+    return text.splitlines()[-lines:]
+
+def _run_on_host(func, args, kwargs, capture_local, tail_lines):
+    """
+    Runs func on the current host, recording every env.run command
+    Returns a HostResult rather than raising
+    """
+    start = time.time()
+    commands = []
+    runner = env.run
+
+    def recording_run(command, *run_args, **run_kwargs):
+        if capture_local:
+            run_kwargs.setdefault("capture", True)
+        with fabric.api.settings(warn_only=True):
+            result = runner(command, *run_args, **run_kwargs)
+        commands.append(result)
+        if result.failed:
+            fabric.utils.abort("{0} exited with {1}".format(command, result.return_code))
+        return result
+
+    output = lambda: _tail("\n".join(
+        "\n".join(part for part in (c, getattr(c, "stderr", "")) if part)
+        for c in commands), tail_lines)
+    exit_code = lambda: commands[-1].return_code if commands else 0
+    try:
+        with fabric.api.settings(run=recording_run):
+            value = func(*args, **kwargs)
+    except Exception as e:
+        return HostResult(env.host_string, False, exit_code() or 1,
+                          time.time() - start, output(), error=str(e))
+    return HostResult(env.host_string, True, exit_code(),
+                      time.time() - start, output(), value=value)
+
+class Session(object):
+    """
+    A room of a project, configured once and reused across operations
+
+    project_dir: the project directory, or any directory below it
+    room: a room name from project.yaml (default: localhost)
+    parallel: run each operation on all hosts at once (the default)
+    output_lines: number of trailing output lines kept per host
+
+    Connections: by default a Session does NOT reuse ssh connections between
+    calls. fabric runs parallel operations in forked worker processes, one per
+    host, and each worker opens its own connection and closes it when it exits.
+    Only the configuration is reused. With parallel=False, operations run on
+    one host after another in this process, and connections stay open until
+    close(). That saves the reconnects, but a room's build takes as long as
+    all of its hosts' builds added together, which is why it is not the default.
+    """
+    def __init__(self, project_dir, room="localhost", parallel=True, output_lines=20):
+        self.project_dir = os.path.abspath(project_dir)
+        self.room = room
+        self.parallel = parallel
+        self.output_lines = output_lines
+        self.reload()
+
+    def reload(self):
+        """
+        Re-reads project.yaml, e.g. after editing it
+        """
+        with fabric.api.settings(abort_exception=ObiError):
+            self.settings = task.room_settings(
+                self.room, task.project_yaml(self.project_dir))
+
+    @property
+    def hosts(self):
+        return list(self.settings["hosts"])
+
+    @property
+    def config(self):
+        return self.settings["config"]
+
+    def _execute(self, func, *args, **kwargs):
+        """
+        Runs func on every host of the room, returns a TaskResults
+        parallel=True/False (default: the session's) is not passed on to func
+        """
+        parallel = kwargs.pop("parallel", self.parallel)
+        # local() only returns output (and stderr) when capturing it
+        capture_local = not self.settings["use_ssh_config"]
+        def host_task():
+            return _run_on_host(func, args, kwargs, capture_local, self.output_lines)
+        if parallel:
+            host_task = fabric.api.parallel(host_task)
+        with self._settings():
+            return TaskResults(fabric.api.execute(host_task))
+
+    def _settings(self):
+        """
+        Context manager applying this session's room to fabric's env
+        """
+        return fabric.api.settings(abort_exception=ObiError, **self.settings)
+
+    def _local_hooks(self, key):
+        """
+        Runs local hooks once, as obi does; raises ObiError if one fails
+        """
+        with self._settings():
+            task.run_local_hooks(key)
+
+    def build(self):
+        """
+        obi build, without the rsync
+        """
+        return self._execute(task.build_task)
+
+    def clean(self):
+        """
+        obi clean
+        """
+        return self._execute(task.clean_task)
+
+    def rsync(self):
+        """
+        obi rsync; a no-op on local rooms
+        Raises ObiError if pre-rsync-cmd fails
+        """
+        if not self.settings["rsync"]:
+            return self._execute(lambda: None)
+        self._local_hooks("pre-rsync-cmd")
+        return self._execute(task.rsync_task)
+
+    def stop(self, force=False):
+        """
+        obi stop
+        Raises ObiError if local-pre-stop-cmds or local-post-stop-cmds fail
+        """
+        self._local_hooks("local-pre-stop-cmds")
+        results = self._execute(task.stop_task, force)
+        if results.ok:
+            self._local_hooks("local-post-stop-cmds")
+        return results
+
+    def launch(self, debugger=None, extras=()):
+        """
+        Launches the application, as the last step of obi go does
+        On local rooms, as with obi go, the application runs in the foreground:
+        launch blocks until it exits, and its exit code and output tail are
+        reported in the HostResult
+        """
+        return self._execute(task.launch_task, debugger, list(extras))
+
+    def fetch(self, files=(), fetch_dir=None, stop=True):
+        """
+        obi fetch: stops the application (unless stop=False) and downloads files
+        (default: the fetch list in project.yaml) to fetch_dir/<host>/
+        fetch_dir defaults to a timestamped directory in the project directory
+        Each HostResult's value is the list of local paths fetched
+        """
+        fetch_dir = fetch_dir or os.path.join(self.settings["local_project_dir"],
+                                              task.default_fetch_dir())
+        if stop:
+            results = self.stop()
+            if not results.ok:
+                return results
+        results = self._execute(task.fetch_task, fetch_dir, list(files))
+        if os.path.isdir(fetch_dir):
+            task.store_git_info(fetch_dir, self.settings["local_project_dir"])
+        return results
+
+    def profile(self, duration=10, fetch_dir=None):
+        """
+        obi profile: samples the running application on every host for
+        duration seconds and fetches the results to fetch_dir/<host>/
+        Folded stacks and flamegraphs are written as by the command line; each
+        HostResult's value is the list of local paths fetched
+        """
+        fetch_dir = fetch_dir or os.path.join(self.settings["local_project_dir"],
+                                              task.default_fetch_dir())
+        # Always sample every host at once, even in a serial session
+        profiled = self._execute(task.profile_task, duration, parallel=True)
+        with self._settings():
+            stacks_file = task.profile_files()[1]
+        results = self._execute(task.fetch_task, fetch_dir, [stacks_file])
+        # Hosts that could not be profiled report that instead of their fetch
+        results.update((host, profiled[host]) for host in profiled.failed)
+        flamegraph.write_flamegraphs(
+            fetch_dir, dict((host, result.value) for host, result in results.items()),
+            self.settings["target_name"])
+        return results
+
+    def go(self, debugger=None, extras=()):
+        """
+        obi go: rsync, build, stop and launch, stopping at the first step that
+        fails on any host. Blocks until the application exits on local rooms
+        (see launch)
+        Returns an OrderedDict of step name -> TaskResults for the steps run
+        """
+        steps = collections.OrderedDict()
+        for name, step in (("rsync", self.rsync),
+                           ("build", self.build),
+                           ("stop", self.stop),
+                           ("launch", lambda: self.launch(debugger, extras))):
+            steps[name] = step()
+            if not steps[name].ok:
+                break
+        return steps
+
+    def close(self):
+        """
+        Closes any ssh connections held open by fabric
+        """
+        fabric.network.disconnect_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
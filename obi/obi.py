@@ -11,6 +11,7 @@ build             Builds the project (optionally, on numerous machines)
 clean             Clean the build directory (optionally, on numerous machines)
 rsync             Rsync your local project directory to remote machines
 fetch             Download remote files to your local project directory
+profile           Sample the running application on every host and fetch flamegraphs
 
 new               Generate a new project, scaffolded from an obi template
 template list     List obi templates
@@ -32,6 +33,7 @@ Usage:
   obi clean [<room>] [--dry-run]
   obi rsync <room> [--dry-run]
   obi fetch <room> [<file>...] [--dry-run]
+  obi profile <room> [--duration=<seconds>] [--dry-run]
   obi new <template> <name> [--template_home=<path>] [--g_speak_home=<path>]
   obi template list [--template_home=<path>]
   obi template install <giturl> [<name>] [--template_home=<path>]
@@ -47,6 +49,7 @@ Options:
   --g_speak_home=<path>   Optional: absolute path of g-speak dir to build against.
   --template_home=<path>  Optional: path containing installed obi templates.
   --debug=<debugger>      Optional: launches the application in a debugger.
+  --duration=<seconds>    Optional: how long to profile for [default: 10].
 """
 
 from __future__ import print_function
@@ -59,8 +62,8 @@ import subprocess
 import errno
 import fabric
 import docopt
-import datetime
 from . import task
+from .task import flamegraph
 from distutils.version import StrictVersion
 import glob
 
@@ -178,48 +181,59 @@ def main():
         print("Project {0} created successfully!".format(arguments['<name>']))
     elif arguments['build']:
         res = fabric.api.execute(task.room_task, room, "build")
-        res.update(fabric.api.execute(fabric.api.env.rsync))
+        res.update(task.rsync_room())
         res.update(fabric.api.execute(task.build_task))
     elif arguments['go']:
         extras = arguments.get('<extras>', [])
         # Gracefully handle keyboard interrupts
         try:
             res = fabric.api.execute(task.room_task, room, "go")
-            res.update(fabric.api.execute(fabric.api.env.rsync))
+            res.update(task.rsync_room())
             res.update(fabric.api.execute(task.build_task))
-            res.update(fabric.api.execute(task.stop_task))
+            res.update(task.stop_room())
             res.update(fabric.api.execute(task.launch_task, arguments['--debug'], extras))
         except KeyboardInterrupt:
             pass
     elif arguments['stop']:
         res = fabric.api.execute(task.room_task, room, "stop")
-        res.update(fabric.api.execute(task.stop_task, arguments["--force"] or arguments["-f"]))
+        res.update(task.stop_room(arguments["--force"] or arguments["-f"]))
     elif arguments['clean']:
         res = fabric.api.execute(task.room_task, room, "clean")
         res.update(fabric.api.execute(task.clean_task))
     elif arguments['rsync']:
         res = fabric.api.execute(task.room_task, room, "rsync")
-        res.update(fabric.api.execute(fabric.api.env.rsync))
+        res.update(task.rsync_room())
     elif arguments['fetch']:
-        timestr = datetime.datetime.now().strftime("%Y%m%d.%H%M%S")
-        fetch_dir = "fetched.{}".format(timestr)
+        fetch_dir = task.default_fetch_dir()
         files = arguments.get('<file>', [])
         res = fabric.api.execute(task.room_task, room, "fetch")
-        res.update(fabric.api.execute(task.stop_task))
+        res.update(task.stop_room())
         res.update(fabric.api.execute(task.fetch_task, fetch_dir, files))
         # Try to store git info
+        task.store_git_info(fetch_dir)
+    elif arguments['profile']:
         try:
-            git_diff = subprocess.check_output(["git", "diff", "HEAD"])
-            with open(os.path.join(fetch_dir, "git.diff"), "w") as git_diff_file:
-                git_diff_file.write(git_diff)
-        except:
-            pass
-        try:
-            git_log = subprocess.check_output(["git", "log"])
-            with open(os.path.join(fetch_dir, "git.log"), "w") as git_log_file:
-                git_log_file.write(git_log)
-        except:
-            pass
+            duration = int(arguments['--duration'])
+        except ValueError:
+            print("--duration must be a whole number of seconds")
+            return 1
+        res = fabric.api.execute(task.room_task, room, "profile")
+        # Absolute, since fetch_task runs under lcd(project_dir) on local rooms
+        # and obi may be run from a subdirectory of the project
+        fetch_dir = os.path.join(fabric.api.env.local_project_dir, task.default_fetch_dir())
+        profiled = fabric.api.execute(task.profile_task, duration)
+        fetched = fabric.api.execute(task.fetch_task, fetch_dir, [task.profile_files()[1]])
+        written = flamegraph.write_flamegraphs(fetch_dir, fetched, fabric.api.env.target_name)
+        if written:
+            print("Wrote:\n{0}".format("\n".join(written)))
+        elif not arguments['--dry-run']:
+            print("No profiles were fetched")
+            return 1
+        # profile_task returns None under --dry-run
+        failed = sorted(host for host, ok in profiled.items() if ok is False)
+        if failed:
+            print("Profiling failed on: {0}".format(", ".join(failed)))
+            return 1
     elif arguments['template']:
         if arguments['list']:
             template_root = arguments["--template_home"] or default_obi_template_dir
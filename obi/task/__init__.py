@@ -1 +1 @@
-from obi.task.task import (dryrun, build_task, clean_task, fetch_task, stop_task, launch_task, room_task, project_yaml, load_project_config)
+from obi.task.task import (dryrun, build_task, clean_task, fetch_task, stop_task, launch_task, profile_task, room_task, room_settings, rsync_room, stop_room, run_local_hooks, project_yaml, load_project_config, profile_files, default_fetch_dir, store_git_info)
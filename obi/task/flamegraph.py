@@ -0,0 +1,121 @@
+'''
+Folding of sampling profiler output for obi profile
+
+Turns `perf script` output into the "folded" one-line-per-stack format read by
+flamegraph.pl (https://github.com/brendangregg/FlameGraph) and speedscope, and
+renders svgs when flamegraph.pl is on the PATH.
+'''
+from __future__ import print_function
+import collections
+import os
+import re
+import subprocess
+from distutils.spawn import find_executable
+from fabric.utils import warn
+
+# "myapp  1234 [002] 5087.241: 10101010 cpu-clock:" or "myapp 1234/1235 ..."
+_sample_header = re.compile(r'^(\S.*?)\s+\d+(?:/\d+)?\s')
+# "	    7f3a1b2c3d4e some_function+0x1f (/usr/lib/libfoo.so)"
+_stack_frame = re.compile(r'^\s+[0-9a-fA-F]+\s+(.*?)\s+\((.*)\)$')
+_symbol_offset = re.compile(r'\+0x[0-9a-fA-F]+$')
+
+def fold_perf_script(lines):
+    """
+    Returns a Counter of folded stack ("comm;outermost;...;innermost") ->
+    number of samples, from the lines of `perf script` output
+    Every unindented line starts a new sample, so output recorded without -g
+    (no call graphs, and no blank lines between samples) folds to one count
+    per sample as well
+    """
+    stacks = collections.Counter()
+    comm = None
+    frames = []
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith("#"):
+            continue
+        if not line.strip() or not line[0].isspace():
+            if comm is not None:
+                stacks[";".join([comm] + frames[::-1])] += 1
+            comm = None
+            frames = []
+            if line.strip():
+                header = _sample_header.match(line)
+                comm = (header.group(1) if header else line.split()[0]).replace(" ", "_")
+        elif comm is not None:
+            frame = _stack_frame.match(line)
+            if not frame:
+                continue
+            symbol, dso = frame.groups()
+            symbol = _symbol_offset.sub("", symbol)
+            if symbol == "[unknown]" and dso != "[unknown]":
+                symbol = "[{0}]".format(os.path.basename(dso))
+            # ';' separates frames in the folded format
+            frames.append(symbol.replace(";", ":"))
+    if comm is not None:
+        stacks[";".join([comm] + frames[::-1])] += 1
+    return stacks
+
+def write_folded(path, stacks):
+    """
+    Writes a Counter of folded stacks to path, one "stack count" per line
+    """
+    with open(path, "w") as folded_file:
+        for stack, count in sorted(stacks.items()):
+            folded_file.write("{0} {1}\n".format(stack, count))
+
+def render_svg(folded_path, svg_path, title):
+    """
+    Renders folded_path to svg_path with flamegraph.pl
+    Returns False if flamegraph.pl is not installed or fails
+    """
+    flamegraph = find_executable("flamegraph.pl")
+    if not flamegraph:
+        return False
+    try:
+        with open(svg_path, "w") as svg_file:
+            subprocess.check_call([flamegraph, "--title", title, folded_path],
+                                  stdout=svg_file)
+    except subprocess.CalledProcessError as e:
+        warn("flamegraph.pl failed to render {0}: {1}".format(folded_path, e))
+        if os.path.exists(svg_path):
+            os.remove(svg_path)
+        return False
+    return True
+
+def write_flamegraphs(fetch_dir, fetched, name):
+    """
+    Folds the `perf script` output fetched from each host into
+    fetch_dir/<host>/<name>.folded, sums them into fetch_dir/<name>.folded,
+    and renders an svg next to each folded file if flamegraph.pl is available
+    fetched maps hosts to the local paths returned by fetch_task
+    Returns the list of files written
+    """
+    written = []
+    merged = collections.Counter()
+    for host, paths in sorted(fetched.items()):
+        # fetch_task results are errors rather than lists for unreachable hosts
+        if not isinstance(paths, list):
+            continue
+        for path in paths:
+            with open(path) as stacks_file:
+                stacks = fold_perf_script(stacks_file)
+            # e.g. the app was idle for the whole duration
+            if not stacks:
+                warn("No samples were recorded on {0}".format(host))
+                continue
+            merged.update(stacks)
+            folded_path = os.path.join(os.path.dirname(path), name + ".folded")
+            write_folded(folded_path, stacks)
+            written.append(folded_path)
+            svg_path = os.path.join(os.path.dirname(path), name + ".svg")
+            if render_svg(folded_path, svg_path, "{0} on {1}".format(name, host)):
+                written.append(svg_path)
+    if merged:
+        folded_path = os.path.join(fetch_dir, name + ".folded")
+        write_folded(folded_path, merged)
+        written.append(folded_path)
+        svg_path = os.path.join(fetch_dir, name + ".svg")
+        if render_svg(folded_path, svg_path, "{0} on all hosts".format(name)):
+            written.append(svg_path)
+    return written
@@ -4,6 +4,7 @@ Implementations for the obi tasks
 - obi stop
 - obi build
 - obi go
+- obi profile
 '''
 from __future__ import print_function
 import hashlib
@@ -13,6 +14,8 @@ import stat
 import time
 import yaml
 import re
+import datetime
+import subprocess
 
 from fabric.api import env  # the global env variable
 from fabric.api import (local, run) # the global env variable
@@ -46,16 +49,24 @@ def room_task(room_name, task_name=None):
     """
     Configures the fabric globabl env variable for other tasks
     """
+    env.update(room_settings(room_name))
+
+def room_settings(room_name, project_config=None):
+    """
+    Returns the fabric env settings for running tasks in room_name, as a Dict
+    project_config defaults to the project.yaml found by project_yaml()
+    """
     # Load the project.yaml file so we can extract configuration for the given room_name
-    project_config = project_yaml()
+    project_config = project_config or project_yaml()
     config = load_project_config(project_config)
 
     # Abort if no project name found
     project_name = config.get("name", None)
     if not project_name:
         abort("No name key found in the project.yaml. Please specify a project name")
-    env.project_name = project_name
-    env.local_project_dir = os.path.dirname(project_config)
+    settings = {}
+    settings["project_name"] = project_name
+    settings["local_project_dir"] = os.path.dirname(project_config)
     # Abort if we cannot find room_name in rooms
     rooms = config.get("rooms", {})
     room = rooms.get(room_name, None)
@@ -67,48 +78,50 @@ def room_task(room_name, task_name=None):
     config_no_rooms = config.copy()
     config_no_rooms.pop("rooms", None)
     # Merge the config of our room into the top-level
-    env.config = config_no_rooms
-    env.config.update(room)
+    settings["config"] = config_no_rooms
+    settings["config"].update(room)
 
     # Calling basename on project_name should be harmless
     # In the case that the user specified target, say, build/foo,
     # then basename gives us foo
-    env.target_name = os.path.basename(
-        env.config.get("target", env.project_name))
+    target_name = os.path.basename(
+        settings["config"].get("target", project_name))
+    settings["target_name"] = target_name
 
     # Running locally if:
     # - User specified is-local: True
     # - Room name is localhost
     # - Hosts is empty
     if room.get("is-local", room_name == "localhost" or not room.get("hosts", [])):
-        env.hosts = ['localhost']
-        env.use_ssh_config = False
-        env.project_dir = env.local_project_dir
-        env.file_exists = os.path.exists
-        env.rsync = lambda: None # Don't rsync when running locally -- noop
-        env.cd = fabric.context_managers.lcd
-        # Generate a shell script that duplicates the task
-        task_name = task_name or env.tasks[-1]
-        env.run = local
-        env.background_run = env.run
-        env.relpath = os.path.relpath
-        env.launch_format_str = "{0} {1}"
-        env.debug_launch_format_str = "{0} {1} {2}"
+        settings["hosts"] = ['localhost']
+        settings["use_ssh_config"] = False
+        settings["project_dir"] = settings["local_project_dir"]
+        settings["file_exists"] = os.path.exists
+        settings["rsync"] = None # Don't rsync when running locally -- see rsync_room
+        settings["cd"] = fabric.context_managers.lcd
+        settings["run"] = local
+        # Looked up at call time, like the remote one, so that wrappers of
+        # env.run (see obi.api) see the launch too
+        settings["background_run"] = lambda cmd: env.run(cmd)
+        settings["relpath"] = os.path.relpath
+        settings["launch_format_str"] = "{0} {1}"
+        settings["debug_launch_format_str"] = "{0} {1} {2}"
     else:
-        env.user = room.get("user", env.local_user) # needed for remote run
-        env.hosts = room.get("hosts", [])
-        env.use_ssh_config = True
+        settings["user"] = room.get("user", env.local_user) # needed for remote run
+        settings["hosts"] = room.get("hosts", [])
+        settings["use_ssh_config"] = True
         # Default remote project dir is /tmp/localusername/projectname
-        env.project_dir = room.get("project-dir", default_remote_project_folder())
-        env.run = run
-        env.background_run = lambda cmd: env.run(cmd, pty=False)
-        env.file_exists = fabric.contrib.files.exists
-        env.rsync = rsync_task
-        env.cd = fabric.context_managers.cd
-        env.relpath = lambda p: p
-        env.launch_format_str = "sh -c '(({0} nohup {1} > {2} 2> {2}) &)'"
-        env.debug_launch_format_str = "tmux new -d -s {0} '{1}'".format(env.target_name, "{0} {1} {2}")
-    env.build_dir = os.path.abspath(env.relpath(os.path.join(env.project_dir, env.config.get("build-dir", "build"))))
+        settings["project_dir"] = room.get("project-dir", default_remote_project_folder(project_name))
+        settings["run"] = run
+        settings["background_run"] = lambda cmd: env.run(cmd, pty=False)
+        settings["file_exists"] = fabric.contrib.files.exists
+        settings["rsync"] = rsync_task
+        settings["cd"] = fabric.context_managers.cd
+        settings["relpath"] = lambda p: p
+        settings["launch_format_str"] = "sh -c '(({0} nohup {1} > {2} 2> {2}) &)'"
+        settings["debug_launch_format_str"] = "tmux new -d -s {0} '{1}'".format(target_name, "{0} {1} {2}")
+    settings["build_dir"] = os.path.abspath(settings["relpath"](os.path.join(settings["project_dir"], settings["config"].get("build-dir", "build"))))
+    return settings
 
 @task
 @parallel
@@ -166,7 +179,9 @@ def build_task():
                 "  || (cmake -H{project_dir} -B{build_dir} {cmake_args} && " \
                 "      echo {sentinel_hash} > {sentinel_path})".format(
                     project_dir=shlexquote(env.project_dir),
-                    build_dir=shlexquote(env.build_dir),
+                    # trailing slash so a build dir named like the target can't match
+            # target_regex in this very command
+            build_dir=shlexquote(env.build_dir + "/"),
                     cmake_args=cmake_args,
                     sentinel_path=shlexquote(sentinel_path),
                     sentinel_hash=sentinel_hash))
@@ -197,11 +212,7 @@ def stop_task(force=False):
     with env.cd(env.project_dir):
         # fall-back to on-stop-cmds for backwards compatibility
         # TODO(jshrake): remove support for the amiguous on-stop-cmds key
-        for cmd in env.config.get("pre-stop-cmds", env.config.get("on-stop-cmds", [])):
-            env.run(cmd)
-    with env.cd(env.project_dir):
-        for cmd in env.config.get("local-pre-stop-cmds", []):
-            local(cmd)
+        run_hooks(env.config.get("pre-stop-cmds", env.config.get("on-stop-cmds", [])))
 
     # target_regex = find_launch_target()
     # why this funny construct? to be extremely specific about what our regex is
@@ -225,11 +236,7 @@ def stop_task(force=False):
     stop_cmd = env.config.get("stop-cmd", default_stop)
     env.run(stop_cmd)
     with env.cd(env.project_dir):
-        for cmd in env.config.get("post-stop-cmds", []):
-            env.run(cmd)
-    with env.cd(env.project_dir):
-        for cmd in env.config.get("local-post-stop-cmds", []):
-            local(cmd)
+        run_hooks(env.config.get("post-stop-cmds", []))
 
 @task
 @parallel
@@ -239,13 +246,53 @@ def fetch_task(fetch_files_to_dir, files):
     """
     fetch_dir = fetch_files_to_dir + '/%(host)s/%(path)s'
     files_to_fetch = files or env.config.get("fetch", [])
+    fetched = []
     with env.cd(env.project_dir):
         for f in files_to_fetch:
             try:
-                fabric.operations.get(f, fetch_dir)
+                fetched.extend(fabric.operations.get(f, fetch_dir))
             # dont fail when f doesn't exist on the remote machines
             except:
                 continue
+    return fetched
+
+@task
+@parallel
+def profile_task(duration):
+    """
+    obi profile
+    Samples the running target for duration seconds, leaving `perf script`
+    output in the build directory for fetch_task
+    Returns False if profiling failed on this host
+    """
+    data_file, stacks_file = profile_files()
+    profiler = env.config.get("profiler", "perf record -F 99 -g")
+    profiler_script = env.config.get("profiler-script", "perf script")
+    # Same pattern as the default stop command. Not run under env.cd, since
+    # the cd prefix could match it too when the project dir is named after the
+    # target.
+    target_regex = "[a-z/]+{0}([[:space:]]|$)".format(env.target_name)
+    profile_cmd = "mkdir -p {build_dir} && rm -f {data} {stacks}; pids=$(pgrep -d, -f {regex}) " \
+        "|| {{ echo 'obi profile: {target} is not running' >&2; exit 1; }}; " \
+        "{profiler} -p $pids -o {data} -- sleep {duration} " \
+        "&& {profiler_script} -i {data} > {stacks}".format(
+            regex=shlexquote(target_regex),
+            target=env.target_name,
+            profiler=profiler,
+            profiler_script=profiler_script,
+            # trailing slash so a build dir named like the target can't match
+            # target_regex in this very command
+            build_dir=shlexquote(env.build_dir + "/"),
+            data=shlexquote(os.path.join(env.project_dir, data_file)),
+            stacks=shlexquote(os.path.join(env.project_dir, stacks_file)),
+            duration=int(duration))
+    # Keep going if one host fails, so the rest of the room still gets profiled
+    with fabric.api.settings(warn_only=True):
+        result = env.run(profile_cmd)
+    if result is not None and result.failed:
+        fabric.utils.warn("obi profile failed on {0}".format(env.host_string))
+        return False
+    return True
 
 @task
 @parallel
@@ -269,8 +316,7 @@ def launch_task(debugger, extras):
 
     with env.cd(env.project_dir):
         # Process pre-launch commands
-        for cmd in env.config.get("pre-launch-cmds", []):
-            env.run(cmd)
+        run_hooks(env.config.get("pre-launch-cmds", []))
         if debugger:
             debug_cmd = debugger
             debuggers = env.config.get("debuggers", None)
@@ -285,8 +331,7 @@ def launch_task(debugger, extras):
             launch_cmd = env.config.get("launch-cmd", default_launch)
             env.background_run(launch_cmd)
         # Process the post-launch commands
-        for cmd in env.config.get("post-launch-cmds", []):
-            env.run(cmd)
+        run_hooks(env.config.get("post-launch-cmds", []))
 
 @task
 @parallel
@@ -294,7 +339,6 @@ def rsync_task():
     """
     Task wrapper around fabric's rsync_project
     """
-    fabric.api.local(env.config.get("pre-rsync-cmd", ""))
     """ NOTE(jshrake): local_dir must end in a trailing slash
     From http://docs.fabfile.org/en/1.11/api/contrib/project.html
     - If local_dir ends with a trailing slash, the files will be
@@ -338,13 +382,14 @@ def load_project_config(config_path):
     except Exception as e:
         abort("Cannot load project.yaml file at {0}\nException: {1}".format(config_path, e))
 
-def project_yaml():
+def project_yaml(start_dir=None):
     """
     Returns the absolute path to the project.yaml file
-    This function will search the current working directory on up to root
+    This function will search start_dir (default: the current working
+    directory) on up to root
     If no project.yaml file is found, aborts
     """
-    current = os.getcwd()
+    current = os.path.abspath(start_dir or os.getcwd())
     parent = parent_dir(current)
     while current != parent:
         test_file = os.path.join(current, "project.yaml")
@@ -353,7 +398,7 @@ def project_yaml():
         else:
             current = parent
             parent = parent_dir(current)
-    abort("Could not find the project.yaml file in {0} or any parent directories".format(os.getcwd()))
+    abort("Could not find the project.yaml file in {0} or any parent directories".format(start_dir or os.getcwd()))
 
 # taken from https://github.com/python/cpython/blob/c80b0175c88be9611b6eea7a60104b4488839a04/Lib/shlex.py#L308
 #_find_unsafe = re.compile(r'[^\w@%+=:,./-]', re.ASCII).search
@@ -367,6 +412,170 @@ def shlexquote(s):
     # the string $'b is then quoted as '$'"'"'b'
     return "'" + s.replace("'", "'\"'\"'") + "'"
 
+def hook_fields(hook):
+    """
+    Returns (cmd, inputs, outputs) for a hook from project.yaml, which is
+    either a plain command string or a map like
+        {cmd: "make-proteins", inputs: ["proteins/*.yaml"], outputs: ["share/*.protein"]}
+    """
+    if not isinstance(hook, dict):
+        return hook, [], []
+    if not hook.get("cmd"):
+        abort("Hook {0} in project.yaml has no cmd key".format(hook))
+    listify = lambda globs: list(globs) if isinstance(globs, (list, tuple)) else [globs] if globs else []
+    return hook["cmd"], listify(hook.get("inputs")), listify(hook.get("outputs"))
+
+_glob_chars = re.compile(r'[*?[]')
+def _literal_prefix(glob):
+    """
+    Returns the part of glob before its first wildcard character
+    """
+    wildcard = _glob_chars.search(glob)
+    return glob[:wildcard.start()] if wildcard else glob
+
+def _globs_overlap(globs_a, globs_b):
+    """
+    True unless no path can match both a glob in globs_a and a glob in globs_b
+    Conservative: globs overlap whenever the literal prefix of one is a prefix
+    of the other, which also covers a directory and the paths inside it
+    """
+    for a in globs_a:
+        for b in globs_b:
+            a, b = os.path.normpath(a), os.path.normpath(b)
+            if b.startswith(_literal_prefix(a)) or a.startswith(_literal_prefix(b)):
+                return True
+    return False
+
+def hook_waves(hooks):
+    """
+    Groups hooks into waves: every hook runs after the hooks earlier in the
+    list that it depends on, and the hooks within a wave are independent.
+    A hook depends on an earlier hook if one reads or writes what the other
+    writes. Hooks without declared inputs or outputs depend on (and are
+    depended on by) everything, so plain command lists keep running in order.
+    Returns a list of lists of (cmd, inputs, outputs)
+    """
+    fields = [hook_fields(hook) for hook in hooks]
+    levels = []
+    for i, (cmd, inputs, outputs) in enumerate(fields):
+        level = 0
+        for j in range(i):
+            _, earlier_inputs, earlier_outputs = fields[j]
+            declared = (inputs or outputs) and (earlier_inputs or earlier_outputs)
+            if not declared \
+                    or _globs_overlap(inputs + outputs, earlier_outputs) \
+                    or _globs_overlap(outputs, earlier_inputs):
+                level = max(level, levels[j] + 1)
+        levels.append(level)
+    waves = [[] for _ in range(max(levels) + 1)] if levels else []
+    for level, hook in zip(levels, fields):
+        waves[level].append(hook)
+    return waves
+
+def hook_fingerprint_cmd(cmd, globs):
+    """
+    Returns shell code printing a hash of cmd and the names and contents of
+    the files matched by globs (directories are hashed recursively)
+    """
+    return "{{ echo {cmd}; for f in {globs}; do find \"$f\" -type f; done 2>/dev/null " \
+        "| LC_ALL=C sort | while IFS= read -r f; do echo \"$f\"; cat \"$f\"; done; }} " \
+        "| {{ sha256sum 2>/dev/null || shasum -a 256; }} | cut -c1-64".format(
+            cmd=shlexquote(cmd), globs=" ".join(globs))
+
+def hook_cmd(cmd, inputs, outputs, stamp_dir):
+    """
+    Returns shell code running hook cmd, or skipping it if its inputs and
+    outputs hash to what was recorded in stamp_dir after its last successful
+    run on this host
+    """
+    if not (inputs or outputs):
+        return cmd
+    # Same idea as the cmake sentinel in build_task
+    # stamp_dir is on the machine running the hook, so it is already per host;
+    # the same cmd with different inputs/outputs gets a stamp of its own
+    stamp_name = hashlib.sha256("\0".join([cmd, "inputs"] + inputs + ["outputs"] + outputs))
+    stamp = os.path.join(stamp_dir, stamp_name.hexdigest())
+    fingerprint = hook_fingerprint_cmd(cmd, inputs + outputs)
+    # An input glob matching no files leaves the hook out of date, rather than
+    # hashing to the same nothing every time
+    inputs_exist = "".join("( set -- {0}; test -e \"$1\" ) && ".format(glob) for glob in inputs)
+    # Braces, so that a `cd dir && ` prefix applies to the whole thing.
+    # An empty hash (no sha256sum or shasum on the host) fails the hook rather
+    # than matching an empty or missing stamp.
+    return "{{ obi_hash=$({fingerprint}); " \
+        "if test -z \"$obi_hash\"; then echo {no_hash} >&2; false; " \
+        "elif {inputs_exist}test \"$(cat {stamp} 2>/dev/null || echo definitelynotashahash)\" = \"$obi_hash\"; " \
+        "then echo {skipped}; " \
+        "else ({cmd}) && mkdir -p {stamp_dir} && {fingerprint} > {stamp}; fi; }}".format(
+            fingerprint=fingerprint,
+            inputs_exist=inputs_exist,
+            stamp=shlexquote(stamp),
+            stamp_dir=shlexquote(stamp_dir),
+            no_hash=shlexquote("obi: cannot hash hook files, need sha256sum or shasum: " + cmd),
+            skipped=shlexquote("obi: up to date, skipping: " + cmd),
+            cmd=cmd)
+
+def run_hooks(hooks, runner=None, stamp_dir=None):
+    """
+    Runs a list of hooks from project.yaml (e.g. pre-launch-cmds) with runner
+    (default: env.run, i.e. on the target host)
+    Hooks that declare inputs/outputs are skipped while up to date, and
+    independent hooks run concurrently (see hook_waves)
+    """
+    runner = runner or env.run
+    stamp_dir = stamp_dir or os.path.join(env.build_dir, "obi-hooks")
+    for wave in hook_waves(hooks):
+        cmds = [hook_cmd(cmd, inputs, outputs, stamp_dir) for cmd, inputs, outputs in wave]
+        if len(cmds) == 1:
+            runner(cmds[0])
+            continue
+        # Run the wave as background jobs of one shell, failing if any fails
+        jobs = " ".join("({0}) & obi_pid{1}=$!;".format(c, i) for i, c in enumerate(cmds))
+        waits = " ".join("wait $obi_pid{0} || obi_status=1;".format(i) for i in range(len(cmds)))
+        runner("{{ {0} obi_status=0; {1} test $obi_status = 0; }}".format(jobs, waits))
+
+def run_local_hooks(key):
+    """
+    Runs the hooks under key in project.yaml (local-*-stop-cmds, pre-rsync-cmd)
+    on your machine. Called once per obi invocation, outside of the @parallel
+    tasks, so that a room of N hosts doesn't run them N times at once
+    """
+    hooks = env.config.get(key, [])
+    # pre-rsync-cmd is a single hook rather than a list
+    if not isinstance(hooks, list):
+        hooks = [hooks] if hooks else []
+    # lcd, not env.cd: on remote rooms env.cd only affects the hosts
+    with fabric.api.lcd(env.local_project_dir):
+        run_hooks(hooks, local, local_hook_stamp_dir())
+
+def rsync_room():
+    """
+    obi rsync: runs pre-rsync-cmd, then rsync_task on every host
+    Does nothing on local rooms
+    """
+    if not env.rsync:
+        return {}
+    run_local_hooks("pre-rsync-cmd")
+    return fabric.api.execute(env.rsync)
+
+def stop_room(force=False):
+    """
+    obi stop: runs stop_task on every host, between local-pre-stop-cmds and
+    local-post-stop-cmds
+    """
+    run_local_hooks("local-pre-stop-cmds")
+    res = fabric.api.execute(stop_task, force)
+    run_local_hooks("local-post-stop-cmds")
+    return res
+
+def local_hook_stamp_dir():
+    """
+    Where hooks run on your machine (local-*-cmds, pre-rsync-cmd) record
+    their up-to-date stamps: obi-hooks in the local build directory
+    """
+    return os.path.join(os.path.abspath(os.path.join(
+        env.local_project_dir, env.config.get("build-dir", "build"))), "obi-hooks")
+
 def find_launch_target():
     """
     returns the absolute path to the binary we're going to launch
@@ -389,8 +598,39 @@ def find_launch_target():
 
     return target
 
-def default_remote_project_folder():
+def profile_files():
+    """
+    Returns the paths, relative to the project directory, of the profiler data
+    and `perf script` output files that obi profile leaves in the build
+    directory (rather than in the source tree, where git and rsync see them)
+    """
+    build_dir = os.path.relpath(env.build_dir, env.project_dir)
+    return (os.path.join(build_dir, env.target_name + ".perf.data"),
+            os.path.join(build_dir, env.target_name + ".perf.stacks"))
+
+def default_fetch_dir():
+    """
+    Returns a timestamped directory name for obi fetch, fetched.YYYYmmdd.HHMMSS
+    """
+    timestr = datetime.datetime.now().strftime("%Y%m%d.%H%M%S")
+    return "fetched.{}".format(timestr)
+
+def store_git_info(fetch_dir, repo_dir=None):
+    """
+    Best-effort: store `git diff HEAD` and `git log` of repo_dir (default: the
+    current working directory) alongside fetched files
+    """
+    for name, cmd in (("git.diff", ["git", "diff", "HEAD"]),
+                      ("git.log", ["git", "log"])):
+        try:
+            output = subprocess.check_output(cmd, cwd=repo_dir)
+            with open(os.path.join(fetch_dir, name), "w") as out_file:
+                out_file.write(output)
+        except:
+            pass
+
+def default_remote_project_folder(project_name=None):
     """
     default destination for remote runs, /tmp/localusername/projectname
     """
-    return os.path.join(os.path.sep, "tmp", env.local_user, env.project_name)
+    return os.path.join(os.path.sep, "tmp", env.local_user, project_name or env.project_name)